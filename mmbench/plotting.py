@@ -20,11 +20,41 @@ import seaborn as sns
 from matplotlib import cm
 import matplotlib.pyplot as plt
 import matplotlib.colors as mcolors
+from matplotlib.ticker import FormatStrFormatter
 from scipy.stats import ttest_1samp
-from scipy.stats import ttest_ind as ttest
+from scipy.stats import t as tdist
 from mmbench.color_utils import print_subtitle, print_result
 
 
+def _pairwise_ttest(samples):
+    """ Compute all pairwise independent two-sample t-tests at once.
+
+    Equivalent to calling scipy.stats.ttest_ind on every pair of rows, but
+    the means and variances are computed once and the whole (k, k) matrix
+    of statistics is derived with vectorized operations.
+
+    Parameters
+    ----------
+    samples: array (k, n)
+        one row of n observations per condition.
+
+    Returns
+    -------
+    tvals: array (k, k)
+        the pairwise t-values.
+    pvals: array (k, k)
+        the associated two-sided p-values.
+    """
+    n_obs = samples.shape[1]
+    means = samples.mean(axis=1)
+    variances = samples.var(axis=1, ddof=1)
+    pooled_se = np.sqrt(
+        (variances[:, None] + variances[None, :]) / n_obs)
+    tvals = (means[:, None] - means[None, :]) / pooled_se
+    pvals = 2 * tdist.sf(np.abs(tvals), 2 * n_obs - 2)
+    return tvals, pvals
+
+
 def plot_barrier_clusters(data, labels, scores, task_name, metric_name):
     """ Display the barrier clustering results.
 
@@ -176,43 +206,42 @@ def plot_bar(key, rsa, ax=None, figsize=(5, 2), dpi=300, fontsize=16,
         fig, ax = plt.subplots(1, 1, figsize=figsize, dpi=dpi)
 
     data = rsa[key]
-    _data = {}
-    for cond in list(data.keys()):
-        _data.setdefault("model fit (r)", []).extend(data[cond])
-        _data.setdefault("condition", []).extend([cond] * len(data[cond]))
-    data_df = pd.DataFrame.from_dict(_data)
-
-    sns.stripplot(data=data_df,
-                  x="condition",
-                  y="model fit (r)",
-                  jitter=0.15,
-                  alpha=1.0,
-                  color="k",
-                  size=marker_size)
-    plot = sns.barplot(data=data_df,
-                       x="condition",
-                       y="model fit (r)",
-                       errcolor="r",
-                       alpha=0.3,
-                       linewidth=line_width,
-                       errwidth=line_width,
-                       palette=palette)
-    for patch in plot.containers[0]:
-        fc = patch.get_edgecolor()
-        patch.set_edgecolor(mcolors.to_rgba(fc, 1.))
+    vals = np.concatenate([np.asarray(val, dtype=np.float64)
+                           for val in data.values()])
+    conds = np.repeat(np.array(list(data.keys())),
+                      [len(val) for val in data.values()])
+    data_df = pd.DataFrame({"model fit (r)": vals, "condition": conds})
+
+    xlabels = list(data.keys())
+    _xlabels = ["\n".join(item.split("_")[:-1]) for item in xlabels]
+    positions = np.arange(len(xlabels))
+    means = np.array([np.mean(data[name]) for name in xlabels])
+    sems = np.array([np.std(data[name], ddof=1) / np.sqrt(len(data[name]))
+                     for name in xlabels])
+    if isinstance(palette, dict):
+        colors = [palette[name] for name in xlabels]
+    else:
+        colors = sns.color_palette(palette, len(xlabels))
+    jitters = [pos + np.random.uniform(-.15, .15, size=len(data[name]))
+               for pos, name in zip(positions, xlabels)]
+    ax.scatter(np.concatenate(jitters), vals, s=marker_size ** 2, color="k",
+               zorder=3)
+    ax.bar(positions, means, yerr=sems,
+           color=[mcolors.to_rgba(col, .3) for col in colors],
+           edgecolor=[mcolors.to_rgba(col, 1.) for col in colors],
+           linewidth=line_width,
+           error_kw={"ecolor": "r", "elinewidth": line_width})
+    ax.set_xticks(positions)
     locs, labels = plt.yticks()
-    new_y = locs
     new_y = np.linspace(locs[0], locs[-1], 6)
-    plt.yticks(new_y, labels=[f"{yy:.2f}" for yy in new_y], fontsize=fontsize,
-               fontweight=fontweight)
+    plt.yticks(new_y, fontsize=fontsize, fontweight=fontweight)
+    ax.yaxis.set_major_formatter(FormatStrFormatter("%.2f"))
     plt.ylabel(yname, fontsize=fontsize, fontweight=fontweight)
     ax.spines["top"].set_visible(False)
     ax.spines["right"].set_visible(False)
     ax.spines["bottom"].set_visible(False)
     for axis in ["top", "bottom", "left", "right"]:
         ax.spines[axis].set_linewidth(line_width)
-    xlabels = [item.get_text() for item in ax.get_xticklabels()]
-    _xlabels = ["\n".join(item.split("_")[:-1]) for item in xlabels]
     ax.set_xticklabels(_xlabels, fontsize=fontsize, fontweight=fontweight)
     x_label = ax.axes.get_xaxis().get_label()
     x_label.set_visible(False)
@@ -224,37 +253,37 @@ def plot_bar(key, rsa, ax=None, figsize=(5, 2), dpi=300, fontsize=16,
         plt.title(title, fontsize=fontsize * 1.5, pad=2, fontweight=fontweight)
 
     if do_one_sample_stars:
-        one_sample_thresh = np.array((1, .05, .001, .0001))
-        one_sample_stars = np.array(("n.s.", "*", "**", "***"))
-        for idx, name in enumerate(xlabels):
-            one_sample = ttest_1samp(data[name], 0)
-            these_stars = one_sample_stars[
-                max(np.nonzero(one_sample.pvalue < one_sample_thresh)[0])]
-            _xlabels[idx] = f"{_xlabels[idx]}\n({these_stars})"
+        one_sample_thresh = np.array((.0001, .001, .05, 1))
+        one_sample_stars = np.array(("***", "**", "*", "n.s."))
+        samples = np.stack([np.asarray(data[name], dtype=np.float64)
+                            for name in xlabels])
+        pvals = ttest_1samp(samples, 0, axis=1).pvalue
+        star_idx = np.searchsorted(one_sample_thresh, pvals, side="right")
+        for idx, stars in enumerate(one_sample_stars[star_idx]):
+            _xlabels[idx] = f"{_xlabels[idx]}\n({stars})"
         ax.set_xticklabels(_xlabels, fontsize=fontsize, fontweight=fontweight)
 
     if report_t or do_pairwise_stars:
-        size = len(xlabels)
-        pairwise_t = np.zeros((size, size))
-        pairwise_p = np.zeros((size, size))
+        samples = np.stack([np.asarray(data[name], dtype=np.float64)
+                            for name in xlabels])
+        n_samples = samples.shape[1]
+        pairwise_t, pairwise_p = _pairwise_ttest(samples)
         _data = dict()
-        for idx1, name1 in enumerate(xlabels):
-            for idx2, name2 in enumerate(xlabels):
-                n_samples = len(data[name1])
-                tval, pval = ttest(data[name1], data[name2])
-                if pval > .001:
-                    print(f"{key} {name1} >  {name2} | "
-                          f"t({n_samples-1}) = {tval:.2f} p = {pval:.2f}")
-                else:
-                    print(f"{key} {name1} >  {name2} | "
-                          f"t({n_samples-1}) = {tval:.2f} p < .001")
-                pairwise_t[idx1, idx2] = tval
-                pairwise_p[idx1, idx2] = pval
-                _data.setdefault("pair", []).append(
-                    f"qname-{key}_src-{name1.replace('_', '-')}_"
-                    f"dest-{name2.replace('_', '-')}")
-                _data.setdefault("tval", []).append(tval)
-                _data.setdefault("pval", []).append(pval)
+        for idx1, idx2 in combinations(range(len(xlabels)), 2):
+            name1, name2 = xlabels[idx1], xlabels[idx2]
+            tval = pairwise_t[idx1, idx2]
+            pval = pairwise_p[idx1, idx2]
+            if pval > .001:
+                print(f"{key} {name1} >  {name2} | "
+                      f"t({n_samples-1}) = {tval:.2f} p = {pval:.2f}")
+            else:
+                print(f"{key} {name1} >  {name2} | "
+                      f"t({n_samples-1}) = {tval:.2f} p < .001")
+            _data.setdefault("pair", []).append(
+                f"qname-{key}_src-{name1.replace('_', '-')}_"
+                f"dest-{name2.replace('_', '-')}")
+            _data.setdefault("tval", []).append(tval)
+            _data.setdefault("pval", []).append(pval)
         pairwise_stat_df = pd.DataFrame.from_dict(_data)
     else:
         pairwise_stat_df = None
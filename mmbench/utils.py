@@ -12,12 +12,12 @@ Define utility functions.
 """
 
 # Imports
-import types
+from collections.abc import Iterator
 
 
 def listify(data):
     """ Listify input data.
     """
-    if isinstance(data, types.GeneratorType):
+    if isinstance(data, Iterator):
         return list(data)
     return [data]
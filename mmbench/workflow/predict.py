@@ -12,13 +12,18 @@ Define the predicction workflows.
 """
 # Imports
 import os
+import hashlib
+import functools
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
 import matplotlib.pyplot as plt
+from joblib import Parallel, delayed
 from sklearn import linear_model
 from sklearn import metrics
+from sklearn.base import is_classifier
 from sklearn.model_selection import cross_val_score
+from sklearn.model_selection import KFold, StratifiedKFold
 from mmbench.color_utils import (
     print_title, print_subtitle, print_text, print_result,
     print_error)
@@ -52,6 +57,8 @@ def benchmark_pred_exp(dataset, datasetdir, datadir, outdir):
       must have the same number of samples and subjects, but possibly
       different latent dimensions.
     - The metadata columns must be the same.
+    - The per score/latent fit results are cached in the 'outdir' in files
+      named 'cache_<key>.npz': remove them to force a recomputation.
     """
     print_title("COMPARE MODELS USING REGRESSIONS "
                 f"OR CLASSIFICATION WITH ML ANALYSIS: {dataset}")
@@ -60,13 +67,21 @@ def benchmark_pred_exp(dataset, datasetdir, datadir, outdir):
     print_text(f"Benchmark directory: {outdir}")
 
     print_subtitle("Loading data...")
-    latent_data_test = np.load(
+    npz_test = np.load(
         os.path.join(datadir, f"latent_vecs_test_{dataset}.npz"))
-    latent_data_train = np.load(
+    npz_train = np.load(
         os.path.join(datadir, f"latent_vecs_train_{dataset}.npz"))
-    assert (sorted(latent_data_test.keys()) ==
-            sorted(latent_data_train.keys())), (
+    assert (sorted(npz_test.keys()) ==
+            sorted(npz_train.keys())), (
                 "latent data must have the same keys")
+    latent_data_test = {
+        key: np.ascontiguousarray(npz_test[key], dtype=np.float32)
+        for key in npz_test.files}
+    latent_data_train = {
+        key: np.ascontiguousarray(npz_train[key], dtype=np.float32)
+        for key in npz_train.files}
+    npz_test.close()
+    npz_train.close()
     meta_df = pd.read_csv(
         os.path.join(datadir, f"latent_meta_test_{dataset}.tsv"), sep="\t")
     meta_df_tr = pd.read_csv(
@@ -83,23 +98,57 @@ def benchmark_pred_exp(dataset, datasetdir, datadir, outdir):
         n_samples, _, _ = samples.shape
 
     print_subtitle("Train model...")
-    res_cv_list, sname = [], []
+    tasks, sname, caches = [], [], {}
+    kfold_splits = list(KFold(n_splits=5).split(np.zeros(len(meta_df_tr))))
     for qname in clinical_scores:
-        y_train = meta_df_tr[qname]
-        y_test = meta_df[qname]
+        y_train = meta_df_tr[qname].to_numpy()
+        y_test = meta_df[qname].to_numpy()
+        clf_factory, scorer, name = get_predictor_factory(y_train)
+        sname.append(name)
+        if name == "MAE":
+            y_train = y_train.astype(np.float32)
+            y_test = y_test.astype(np.float32)
+        if is_classifier(clf_factory()):
+            cv_splits = list(StratifiedKFold(n_splits=5).split(
+                np.zeros(len(y_train)), y_train))
+        else:
+            cv_splits = kfold_splits
         for latent_key in latent_data_test:
-            print_text(f"- {qname} - {latent_key}...")
-            res, res_cv = [], []
             samples_train = latent_data_train[latent_key]
             samples_test = latent_data_test[latent_key]
-            for idx in tqdm(range(n_samples)):
-                clf, scorer, name = get_predictor(y_train)
-                scores = cross_val_score(
-                    clf, samples_train[idx], y_train, cv=5, scoring=scorer,
-                    n_jobs=-1)
-                clf.fit(samples_train[idx], y_train)
-                res_cv.append(f"{scores.mean():.2f} +/- {scores.std():.2f}")
-                res.append(scorer(clf, samples_test[idx], y_test))
+            cache_key = hashlib.sha1(
+                (latent_key + qname + str(samples_train.shape) +
+                 str(n_samples)).encode()).hexdigest()[:12]
+            cache_file = os.path.join(outdir, f"cache_{cache_key}.npz")
+            if os.path.isfile(cache_file):
+                print_text(f"- {qname} - {latent_key}: use cache "
+                           f"{cache_file}")
+                cache = np.load(cache_file)
+                caches[(qname, latent_key)] = (
+                    cache["res_cv"].tolist(), cache["res"])
+                continue
+            caches[(qname, latent_key)] = cache_file
+            print_text(f"- {qname} - {latent_key}...")
+            for idx in range(n_samples):
+                tasks.append(delayed(_fit_one)(
+                    samples_train[idx], samples_test[idx], y_train, y_test,
+                    cv_splits, clf_factory, scorer, qname, latent_key, idx))
+    fit_results = Parallel(n_jobs=-1, backend="loky", batch_size="auto")(
+        tqdm(tasks))
+    res_cv_list = []
+    pos = 0
+    for qname in clinical_scores:
+        for latent_key in latent_data_test:
+            cache = caches[(qname, latent_key)]
+            if isinstance(cache, str):
+                chunk = fit_results[pos:pos + n_samples]
+                pos += n_samples
+                res_cv = [item[0] for item in chunk]
+                res = [item[1] for item in chunk]
+                np.savez(cache, res_cv=np.asarray(res_cv),
+                         res=np.asarray(res))
+            else:
+                res_cv, res = cache
             res_cv_df = pd.DataFrame.from_dict(
                 {"model": range(n_samples), "score": res_cv})
             res_cv_df["qname"] = qname
@@ -107,10 +156,11 @@ def benchmark_pred_exp(dataset, datasetdir, datadir, outdir):
             print(res_cv_df)
             res_cv_list.append(res_cv_df)
             predict_results.setdefault(qname, {})[latent_key] = np.asarray(res)
-        sname.append(name)
-    predict_df = pd.DataFrame.from_dict(predict_results, orient="index")
-    predict_df = pd.concat([predict_df[col].explode() for col in predict_df],
-                           axis="columns")
+    predict_df = pd.DataFrame(
+        {latent_key: np.concatenate(
+            [predict_results[qname][latent_key]
+             for qname in predict_results])
+         for latent_key in latent_data_test})
     predict_df.to_csv(os.path.join(outdir, "predict.tsv"), sep="\t",
                       index=False)
     _df = pd.concat(res_cv_list)
@@ -144,6 +194,57 @@ def benchmark_pred_exp(dataset, datasetdir, datadir, outdir):
     print_result(f"PREDICT: {filename}")
 
 
+def _fit_one(samples_train, samples_test, y_train, y_test, cv_splits,
+             clf_factory, scorer, qname, latent_key, idx):
+    """ Train and evaluate a predictor on a single latent sampling.
+
+    Parameters
+    ----------
+    samples_train: array (n_subjects, latent_dim)
+        the latent samples used to train the predictor.
+    samples_test: array (n_subjects, latent_dim)
+        the latent samples used to evaluate the predictor.
+    y_train: array (n_subjects, )
+        the train predicted variable.
+    y_test: array (n_subjects, )
+        the test predicted variable.
+    cv_splits: list of (array, array)
+        the precomputed cross-validation train/test indices.
+    clf_factory: callable
+        a callable returning a fresh classifier or regressor.
+    scorer: callable
+        a scorer callable object/function with signature which returns a
+        single value.
+    qname: str
+        the name of the predicted clinical score.
+    latent_key: str
+        the latent data identifier.
+    idx: int
+        the sampling index.
+
+    Returns
+    -------
+    res_cv: str
+        the formatted cross-validation score.
+    res: float
+        the score obtained on the test set.
+    """
+    clf = clf_factory()
+    # The data are worker-local copies: let the solver work in place, and
+    # center train/test with the train mean, which leaves the predictions
+    # of the intercept-based Ridge models unchanged.
+    clf.set_params(copy_X=False)
+    mean = samples_train.mean(axis=0)
+    samples_train = samples_train - mean
+    samples_test = samples_test - mean
+    scores = cross_val_score(
+        clf, samples_train, y_train, cv=cv_splits, scoring=scorer, n_jobs=1)
+    clf.fit(samples_train, y_train)
+    res_cv = f"{scores.mean():.2f} +/- {scores.std():.2f}"
+    res = scorer(clf, samples_test, y_test)
+    return res_cv, res
+
+
 def get_predictor(data):
     """ Return a classifier and a BAcc metric if the data is of type int or
     str, otherwise a regressor and a MAE metric.
@@ -163,17 +264,52 @@ def get_predictor(data):
     name: str
         the name of the scorer.
     """
+    factory, scorer, name = get_predictor_factory(data)
+    return factory(), scorer, name
+
+
+def get_predictor_factory(data):
+    """ Return a classifier factory and a BAcc metric if the data is of type
+    int or str, otherwise a regressor factory and a MAE metric.
+
+    The predictor type is decided once from the data, so the returned
+    factory can be called repeatedly to produce fresh estimators without
+    re-scanning the data.
+
+    Parameters
+    ----------
+    data: list
+        list of value that will be submitted to a predictor.
+
+    Returns
+    -------
+    factory: callable
+        a callable returning a fresh classifier or regressor.
+    scorer: callable
+        a scorer callable object/function with signature which returns a
+        single value.
+    name: str
+        the name of the scorer.
+    """
     data = np.array(data)
-    is_int = ((data - data.astype(int) == 0).all()
-              if not isinstance(data[0], str) else False)
-    if isinstance(data[0], str) or is_int:
-        predictor = linear_model.RidgeClassifier()
+    kind = data.dtype.kind
+    if kind in "iub":
+        is_classif = True
+    elif kind in "OUS":
+        is_classif = (isinstance(data[0], str)
+                      or not np.any(np.mod(data, 1)))
+    else:
+        is_classif = not np.any(np.mod(data, 1))
+    if is_classif:
+        factory = functools.partial(linear_model.RidgeClassifier,
+                                    solver="lsqr")
         scorer = metrics.get_scorer("balanced_accuracy")
         name = "BAcc"
     else:
-        predictor = linear_model.Ridge(alpha=.5)
+        factory = functools.partial(linear_model.Ridge, alpha=.5,
+                                    solver="lsqr")
         scorer = metrics.get_scorer("neg_mean_absolute_error")
         scorer = metrics.make_scorer(scorer._score_func,
                                      greater_is_better=True)
         name = "MAE"
-    return predictor, scorer, name
+    return factory, scorer, name